@@ -1,138 +1,333 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import hashlib
+import io
+import mmap
 import os
+import pickle
 import re
+import shutil
 import subprocess
 import sys
-from dataclasses import dataclass
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Literal, Union
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Tuple, Union
 
+# Opening or closing display tag, e.g. `-- <name>` or `-- </name>`, on a line
+# of its own. Tags are paired up by `parse_display_snippets`; tag names are
+# checked with `is_tag_name` after decoding.
+DISPLAY_TAG_PATTERN = re.compile(
+    rb"^[^\S\n]*--[^\S\n]*<(/?)([^\s<>/]+)>[^\S\n]*$", re.MULTILINE
+)
 
-@dataclass
-class DisplaySnippet:
-    name: str
-    kind: Literal["display"]
-    line_offset: int
-    line_count: int
+# Inline tag pair, e.g. `{- <name> -} ... {- </name> -}`
+INLINE_PATTERN = re.compile(r"\{-\s*<(\w+)>\s*-\}(.*?)\{-\s*</\1>\s*-\}")
 
+# Tag written before each katla output in the macro file: its key and size
+MACRO_TAG_PATTERN = re.compile(rb"^% katla-hash:([0-9a-f]+) ([0-9]+)\n", re.MULTILINE)
 
-@dataclass
-class InlineSnippet:
-    name: str
-    kind: Literal["inline"]
-    line_offset: int
-    column_start_offset: int
-    column_end_offset: int
+# katla subcommands generating a macro for each snippet kind
+DISPLAY_MACRO_ARGS = ("latex", "macro")
+INLINE_MACRO_ARGS = ("latex", "macro", "inline")
 
+# Serialises output from katla commands running in worker threads
+print_lock = threading.Lock()
 
-Snippet = Union[DisplaySnippet, InlineSnippet]
 
+# Snippet kinds
+DISPLAY = 0
+INLINE = 1
+KIND_NAMES = ("display", "inline")
 
-def parse_display_snippets(lines: List[str]) -> List[DisplaySnippet]:
-    """Parse display style snippets from lines."""
-    snippets: List[DisplaySnippet] = []
-    i = 0
 
-    while i < len(lines):
-        line = lines[i].strip()
+class Snippet(NamedTuple):
+    """A display or inline snippet; fields unused by its kind are -1."""
 
-        # Look for opening display tag
-        display_start_match = re.match(r"^--\s*<(\w+)>\s*$", line)
-        if display_start_match:
-            name = display_start_match.group(1)
-            start_line = i
+    name: str
+    kind: int
+    line_offset: int
+    line_count: int
+    column_start_offset: int
+    column_end_offset: int
 
-            # Look for matching closing tag
-            j = i + 1
-            found_end = False
-            while j < len(lines):
-                end_line = lines[j].strip()
-                display_end_match = re.match(
-                    rf"^--\s*</{re.escape(name)}>\s*$", end_line
-                )
-                if display_end_match:
-                    line_offset = start_line + 1  # 1-indexed
-                    line_count = j - start_line - 1  # Lines between tags
-                    snippets.append(
-                        DisplaySnippet(
-                            name=name,
-                            kind="display",
-                            line_offset=line_offset,
-                            line_count=line_count,
-                        )
-                    )
-                    found_end = True
-                    break
-                j += 1
 
-            if not found_end:
-                print(
-                    f"Warning: Unclosed display tag '<{name}>' at line {start_line + 1}",
-                    file=sys.stderr,
+@dataclass
+class ParsedFile:
+    """Snippets found in a source file, along with its line table."""
+
+    snippets: List[Snippet]
+    # Byte offset at which each line of the file starts
+    line_starts: List[int]
+    # Raw file contents, only kept if requested from `parse_file`
+    contents: bytes = b""
+    # Set if the file could not be read or parsed
+    failed: bool = False
+    # Warnings printed while parsing, e.g. about unclosed tags
+    warnings: List[str] = field(default_factory=list)
+
+
+# Cached snippets of a source file:
+# (st_mtime_ns, st_size, snippet tuples, parse warnings)
+CacheEntry = Tuple[int, int, List[Tuple[str, int, int, int, int, int]], List[str]]
+
+
+def is_tag_name(name: str) -> bool:
+    """Check whether a tag name consists of word characters only, like `\\w+`."""
+    return name != "" and all(c == "_" or c.isalnum() for c in name)
+
+
+def find_line_starts(data: Union[bytes, mmap.mmap]) -> List[int]:
+    """Return the byte offset at which each line of the file starts."""
+    line_starts = [0]
+    pos = data.find(b"\n")
+    while pos != -1:
+        line_starts.append(pos + 1)
+        pos = data.find(b"\n", pos + 1)
+    return line_starts
+
+
+def line_at(line_starts: List[int], pos: int) -> int:
+    """Return the 0-indexed line containing byte offset `pos`."""
+    return bisect.bisect_right(line_starts, pos) - 1
+
+
+def parse_display_snippets(
+    data: Union[bytes, mmap.mmap], line_starts: List[int], warnings: List[str]
+) -> List[Snippet]:
+    """Parse display style snippets from the UTF-8 encoded contents of a file."""
+    snippets: List[Snippet] = []
+    # Display tags still waiting for their closing tag: name -> start lines
+    open_display: Dict[str, List[int]] = {}
+
+    for match in DISPLAY_TAG_PATTERN.finditer(data):
+        name = match.group(2).decode("utf-8")
+        line_idx = line_at(line_starts, match.start())
+
+        if match.group(1):
+            # Closing display tag of every pending opening tag
+            for start_line in open_display.pop(name, []):
+                snippets.append(
+                    Snippet(
+                        name=name,
+                        kind=DISPLAY,
+                        line_offset=start_line + 1,  # 1-indexed
+                        line_count=line_idx - start_line - 1,  # Lines between tags
+                        column_start_offset=-1,
+                        column_end_offset=-1,
+                    )
                 )
+        elif is_tag_name(name):
+            # Opening display tag
+            open_display.setdefault(name, []).append(line_idx)
+
+    unclosed = sorted(
+        (start_line, name)
+        for name, start_lines in open_display.items()
+        for start_line in start_lines
+    )
+    for start_line, name in unclosed:
+        warnings.append(
+            f"Warning: Unclosed display tag '<{name}>' at line {start_line + 1}"
+        )
 
-        i += 1
+    # Display snippets are emitted at their closing tag; report them in the
+    # order they were opened
+    snippets.sort(key=lambda snippet: snippet.line_offset)
 
     return snippets
 
 
-def parse_inline_snippets(lines: List[str]) -> List[InlineSnippet]:
-    """Parse inline style snippets from lines."""
-    snippets: List[InlineSnippet] = []
-
-    for line_idx, line in enumerate(lines):
-        # Find all inline comment pairs on this line
-        inline_pattern = r"\{-\s*<(\w+)>\s*-\}(.*?)\{-\s*</\1>\s*-\}"
-        matches = re.finditer(inline_pattern, line)
-
-        for match in matches:
-            name = match.group(1)
-            start_pos = match.start()
-            end_pos = match.end()
-
-            # Find the position right after the opening tag
-            opening_tag_end = line.find("-}", start_pos) + 2
-            # Find the position right before the closing tag
-            closing_tag_start = line.rfind("{-", start_pos, end_pos)
+def parse_inline_snippets(lines: Iterable[bytes]) -> List[Snippet]:
+    """Parse inline style snippets from UTF-8 encoded lines."""
+    snippets: List[Snippet] = []
 
-            column_start_offset = opening_tag_end
-            column_end_offset = closing_tag_start
+    for line_idx, raw in enumerate(lines):
+        # Skip lines without both halves of an inline tag before decoding them
+        if b"{-" not in raw or b"-}" not in raw:
+            continue
 
+        # Find all inline comment pairs on this line; columns are counted in
+        # characters, so match against the decoded line
+        for match in INLINE_PATTERN.finditer(raw.decode("utf-8")):
             snippets.append(
-                InlineSnippet(
-                    name=name,
-                    kind="inline",
+                Snippet(
+                    name=match.group(1),
+                    kind=INLINE,
                     line_offset=line_idx + 1,  # 1-indexed
-                    column_start_offset=column_start_offset,
-                    column_end_offset=column_end_offset,
+                    line_count=-1,
+                    # The content group spans from right after the opening
+                    # tag to right before the closing tag
+                    column_start_offset=match.start(2),
+                    column_end_offset=match.end(2),
                 )
             )
 
     return snippets
 
 
-def parse_file(filepath: str) -> List[Snippet]:
-    """Parse an Idris file and return all snippets found."""
+def parse_file(filepath: str, keep_contents: bool = False) -> ParsedFile:
+    """Parse an Idris file and return its snippets, optionally with its contents."""
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+        with open(filepath, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be memory-mapped
+                return ParsedFile(snippets=[], line_starts=[0])
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                line_starts = find_line_starts(data)
+                warnings: List[str] = []
+                display_snippets = parse_display_snippets(data, line_starts, warnings)
+                inline_snippets = parse_inline_snippets(iter(data.readline, b""))
+                contents = data[:] if keep_contents else b""
+
+        for warning in warnings:
+            print(warning, file=sys.stderr)
+
+        return ParsedFile(
+            snippets=display_snippets + inline_snippets,
+            line_starts=line_starts,
+            contents=contents,
+            warnings=warnings,
+        )
+
+    except FileNotFoundError:
+        print(f"Error: File '{filepath}' not found", file=sys.stderr)
+        return ParsedFile(snippets=[], line_starts=[0], failed=True)
+    except Exception as e:
+        print(f"Error parsing file '{filepath}': {e}", file=sys.stderr)
+        return ParsedFile(snippets=[], line_starts=[0], failed=True)
+
+
+def file_stamp(filepath: str) -> Tuple[int, int]:
+    """Return the mtime and size of a file."""
+    st = os.stat(filepath)
+    return (st.st_mtime_ns, st.st_size)
 
-        # Remove newlines but keep them for accurate parsing
-        lines = [line.rstrip("\n\r") for line in lines]
 
-        display_snippets = parse_display_snippets(lines)
-        inline_snippets = parse_inline_snippets(lines)
+def script_stamp() -> Tuple[int, int]:
+    """Return the mtime and size of this script, used to invalidate the cache."""
+    return file_stamp(__file__)
 
-        return display_snippets + inline_snippets
 
+def load_snippet_cache(cache_file: Path) -> Dict[str, CacheEntry]:
+    """Load cached snippets, or return an empty cache if missing or stale."""
+    try:
+        with open(cache_file, "rb") as f:
+            stamp, entries = pickle.load(f)
     except FileNotFoundError:
-        print(f"Error: File '{filepath}' not found", file=sys.stderr)
-        return []
+        return {}
     except Exception as e:
-        print(f"Error parsing file '{filepath}': {e}", file=sys.stderr)
-        return []
+        print(f"Warning: Ignoring unreadable snippet cache: {e}", file=sys.stderr)
+        return {}
+
+    # Changes to the parser invalidate every cached entry
+    if stamp != script_stamp():
+        return {}
+    return entries
+
+
+def save_snippet_cache(cache_file: Path, cache: Dict[str, CacheEntry]):
+    """Write cached snippets to disk."""
+    try:
+        with open(cache_file, "wb") as f:
+            pickle.dump((script_stamp(), cache), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print(f"Warning: Could not write snippet cache: {e}", file=sys.stderr)
+
+
+def parse_file_cached(filepath: str, cache: Dict[str, CacheEntry]) -> List[Snippet]:
+    """Parse an Idris file, reusing cached snippets if it is unchanged."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return parse_file(filepath).snippets
+
+    key = os.path.abspath(filepath)
+    entry = cache.get(key)
+    if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+        # The file is unchanged, so it still has the same problems
+        for warning in entry[3]:
+            print(warning, file=sys.stderr)
+        return [Snippet._make(fields) for fields in entry[2]]
+
+    parsed = parse_file(filepath)
+    if parsed.failed:
+        # Keep reporting the error until the file is fixed
+        cache.pop(key, None)
+        return parsed.snippets
+
+    # Store plain tuples rather than pickling references to the Snippet class
+    cache[key] = (
+        st.st_mtime_ns,
+        st.st_size,
+        [tuple(s) for s in parsed.snippets],
+        parsed.warnings,
+    )
+    return parsed.snippets
+
+
+def digest_file(filepath: str) -> bytes:
+    """Return a BLAKE2 digest of the contents of a file."""
+    with open(filepath, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").digest()
+
+
+def macro_key(inputs_digest: bytes, cmd: Tuple[str, ...]) -> str:
+    """Return a key identifying the output of a katla command."""
+    h = hashlib.blake2b(inputs_digest, digest_size=16)
+    h.update(repr(cmd).encode())
+    return h.hexdigest()
+
+
+def load_previous_macros(output_file: Path) -> Dict[str, bytes]:
+    """Return the tagged katla outputs of a previously generated macro file."""
+    try:
+        with open(output_file, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    except OSError as e:
+        print(f"Warning: Ignoring unreadable macro file: {e}", file=sys.stderr)
+        return {}
+
+    macros: Dict[str, bytes] = {}
+    for match in MACRO_TAG_PATTERN.finditer(data):
+        end = match.end() + int(match.group(2))
+        if end <= len(data):
+            macros[match.group(1).decode()] = data[match.end() : end]
+    return macros
+
+
+def katla_command(
+    snippet: Snippet, src_file: str, ttm_file: str, katla: str = "katla"
+) -> Tuple[str, ...]:
+    """Return the katla command generating the macro for a snippet."""
+    if snippet.kind == DISPLAY:
+        return (
+            katla,
+            *DISPLAY_MACRO_ARGS,
+            snippet.name,
+            src_file,
+            ttm_file,
+            str(snippet.line_offset + 1),
+            "0",
+            str(snippet.line_count - 1),
+        )
+    else:
+        return (
+            katla,
+            *INLINE_MACRO_ARGS,
+            snippet.name,
+            src_file,
+            ttm_file,
+            "0",
+            str(snippet.line_offset),
+            str(snippet.column_start_offset + 1),
+            str(snippet.column_end_offset),
+        )
 
 
 def run_katla_command(
@@ -140,85 +335,78 @@ def run_katla_command(
     src_file: str,
     ttm_file: str,
     dry_run: bool = False,
-) -> str:
+    katla: str = "katla",
+) -> bytes:
     """Run the appropriate katla command for a snippet and return the output."""
-    match snippet.kind:
-        case "display":
-            cmd = [
-                "katla",
-                "latex",
-                "macro",
-                snippet.name,
-                src_file,
-                ttm_file,
-                str(snippet.line_offset + 1),
-                "0",
-                str(snippet.line_count - 1),
-            ]
-        case "inline":
-            cmd = [
-                "katla",
-                "latex",
-                "macro",
-                "inline",
-                snippet.name,
-                src_file,
-                ttm_file,
-                "0",
-                str(snippet.line_offset),
-                str(snippet.column_start_offset + 1),
-                str(snippet.column_end_offset),
-            ]
+    cmd = katla_command(snippet, src_file, ttm_file, katla)
 
     if dry_run:
-        print(f"Would run: {' '.join(cmd)}")
-        return f"% Dry run - would generate macro for {snippet.name}\n"
+        with print_lock:
+            print(f"Would run: {' '.join(cmd)}")
+        return f"% Dry run - would generate macro for {snippet.name}\n".encode()
 
     try:
-        # Run katla command and capture output
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # Run katla command and capture output; it is written to the macro
+        # file verbatim, so it is only decoded for error messages
+        result = subprocess.run(cmd, capture_output=True)
 
         if result.returncode != 0:
+            stderr = result.stderr.decode("utf-8", errors="replace")
+            with print_lock:
+                print(
+                    f"Error running katla for {snippet.name}: {stderr}",
+                    file=sys.stderr,
+                )
+            return f"% Error generating macro for {snippet.name}\n".encode()
+
+        with print_lock:
+            print(f"Generated macro for {snippet.name}")
+        return result.stdout
+
+    except Exception as e:
+        with print_lock:
             print(
-                f"Error running katla for {snippet.name}: {result.stderr}",
+                f"Error running katla command for {snippet.name}: {e}",
                 file=sys.stderr,
             )
-            return f"% Error generating macro for {snippet.name}\n"
+        return f"% Error generating macro for {snippet.name}\n".encode()
 
-        print(f"Generated macro for {snippet.name}")
-        return result.stdout
 
-    except Exception as e:
-        print(f"Error running katla command for {snippet.name}: {e}", file=sys.stderr)
-        return f"% Error generating macro for {snippet.name}\n"
+def read_line(data: bytes, line_starts: List[int], line_idx: int) -> str:
+    """Return the 0-indexed line of a file without its line ending."""
+    start = line_starts[line_idx]
+    end = line_starts[line_idx + 1] if line_idx + 1 < len(line_starts) else len(data)
+    return data[start:end].decode("utf-8").rstrip("\n\r")
 
 
-def print_snippet_debug(snippet: Snippet, src_file: str, lines: List[str]):
+def print_snippet_debug(snippet: Snippet, src_file: str, parsed: ParsedFile):
     """Print debug information about a snippet including its content."""
-    print(f"Snippet: {snippet.name} ({snippet.kind})")
+    data = parsed.contents
+    line_starts = parsed.line_starts
+    print(f"Snippet: {snippet.name} ({KIND_NAMES[snippet.kind]})")
     print(f"  File: {src_file}")
 
-    match snippet.kind:
-        case "display":
-            print(f"  Line offset: {snippet.line_offset}")
-            print(f"  Line count: {snippet.line_count}")
-            print("  Content:")
-            start_line = (
-                snippet.line_offset
-            )  # Already 1-indexed, but we need 0-indexed for array access
-            end_line = start_line + snippet.line_count
-            for i in range(start_line, min(end_line, len(lines))):
-                print(f"    {i+1}: {lines[i]}")
-        case "inline":
-            print(f"  Line offset: {snippet.line_offset}")
-            print(f"  Column start: {snippet.column_start_offset}")
-            print(f"  Column end: {snippet.column_end_offset}")
-            line_content = lines[snippet.line_offset - 1]  # Convert to 0-indexed
-            snippet_content = line_content[
-                snippet.column_start_offset : snippet.column_end_offset
-            ]
-            print(f"  Line content: {line_content}")
-            print(f"  Snippet content: '{snippet_content}'")
+    if snippet.kind == DISPLAY:
+        print(f"  Line offset: {snippet.line_offset}")
+        print(f"  Line count: {snippet.line_count}")
+        print("  Content:")
+        start_line = (
+            snippet.line_offset
+        )  # Already 1-indexed, but we need 0-indexed for array access
+        end_line = start_line + snippet.line_count
+        for i in range(start_line, min(end_line, len(line_starts))):
+            print(f"    {i+1}: {read_line(data, line_starts, i)}")
+    else:
+        print(f"  Line offset: {snippet.line_offset}")
+        print(f"  Column start: {snippet.column_start_offset}")
+        print(f"  Column end: {snippet.column_end_offset}")
+        # Convert to 0-indexed
+        line_content = read_line(data, line_starts, snippet.line_offset - 1)
+        snippet_content = line_content[
+            snippet.column_start_offset : snippet.column_end_offset
+        ]
+        print(f"  Line content: {line_content}")
+        print(f"  Snippet content: '{snippet_content}'")
 
     print()
 
@@ -242,9 +430,38 @@ def main():
         action="store_true",
         help="Debug dry-run mode: print snippets and their contents without running katla",
     )
+    parser.add_argument(
+        "--katla",
+        default="katla",
+        help="Name or path of the katla executable (default: katla)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=min(32, (os.cpu_count() or 1) * 4),
+        help="Number of katla commands to run in parallel",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Reparse every source file and rerun katla for every snippet",
+    )
 
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        print("Error: --jobs must be at least 1", file=sys.stderr)
+        sys.exit(1)
+
+    # Resolve katla once rather than searching PATH for every snippet
+    katla = shutil.which(args.katla)
+    if katla is None:
+        if not args.dry_run:
+            print(f"Error: katla executable '{args.katla}' not found", file=sys.stderr)
+            sys.exit(1)
+        katla = args.katla
+
     # Parse file pairs
     if len(args.files) % 2 != 0:
         print(
@@ -259,79 +476,146 @@ def main():
 
     total_success = 0
     total_snippets = 0
-    all_macro_content: List[str] = []
-
-    # Generate header for the combined file
-    all_macro_content.append("% Generated LaTeX macros for all Idris files\n")
-    all_macro_content.append("% Generated by gen-katla.py\n\n")
-
-    for src_file, ttm_file in file_pairs:
-        print(f"Processing {src_file} -> {ttm_file}")
-
-        # Check if files exist
-        if not os.path.exists(src_file):
-            print(f"Error: Source file '{src_file}' not found", file=sys.stderr)
-            continue
-        if not args.dry_run and not os.path.exists(ttm_file):
-            print(f"Error: TTM file '{ttm_file}' not found", file=sys.stderr)
-            continue
-
-        snippets = parse_file(src_file)
-        total_snippets += len(snippets)
+    output_file = Path(args.output_dir) / "katla-macros.tex"
+    cache_file = Path(args.output_dir) / ".snippet-cache"
+    cache = {} if args.no_cache else load_snippet_cache(cache_file)
+    # Read before the macro file is overwritten below
+    previous_macros = (
+        {} if args.no_cache or args.dry_run else load_previous_macros(output_file)
+    )
 
+    try:
         if args.dry_run:
-            print(f"Found {len(snippets)} snippets in {src_file}:")
-            # Read file lines for debug output
-            try:
-                with open(src_file, "r", encoding="utf-8") as f:
-                    lines = [line.rstrip("\n\r") for line in f.readlines()]
-
-                for snippet in snippets:
-                    print_snippet_debug(snippet, src_file, lines)
-            except Exception as e:
-                print(f"Error reading file for debug: {e}", file=sys.stderr)
+            # Nothing is written in dry run, only buffered to report its size
+            out: BinaryIO = io.BytesIO()
         else:
-            print(f"Found {len(snippets)} snippets")
-            # Add file header to the combined content
-            if snippets:
-                all_macro_content.append(f"% Macros from {src_file}\n")
-
-            for snippet in snippets:
-                macro_output = run_katla_command(
-                    snippet, src_file, ttm_file, args.dry_run
-                )
-                if macro_output and not macro_output.startswith("% Error"):
-                    all_macro_content.append(macro_output)
-                    if not macro_output.endswith("\n"):
-                        all_macro_content.append("\n")
-                    total_success += 1
-                elif macro_output:
-                    all_macro_content.append(macro_output)
-
-            if snippets:
-                all_macro_content.append("\n")
-
-    # Write all macros to a single file
-    if not args.dry_run:
-        output_file = Path(args.output_dir) / "katla-macros.tex"
-        output_file.parent.mkdir(parents=True, exist_ok=True)
-
-        try:
-            with open(output_file, "w") as f:
-                f.writelines(all_macro_content)
-            print(f"\nGenerated combined macro file: {output_file}")
-        except Exception as e:
-            print(f"Error writing combined macro file: {e}", file=sys.stderr)
-            sys.exit(1)
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            # Macros are streamed to disk as they are generated
+            out = open(output_file, "wb", buffering=1 << 20)
+
+        with out:
+            # Generate header for the combined file
+            out.write(b"% Generated LaTeX macros for all Idris files\n")
+            out.write(b"% Generated by gen-katla.py\n\n")
+
+            for src_file, ttm_file in file_pairs:
+                print(f"Processing {src_file} -> {ttm_file}")
+
+                # Check if files exist
+                if not os.path.exists(src_file):
+                    print(f"Error: Source file '{src_file}' not found", file=sys.stderr)
+                    continue
+                if not args.dry_run and not os.path.exists(ttm_file):
+                    print(f"Error: TTM file '{ttm_file}' not found", file=sys.stderr)
+                    continue
+
+                if args.dry_run:
+                    # Debug output needs the file contents and line table, so
+                    # always parse
+                    parsed = parse_file(src_file, keep_contents=True)
+                    total_snippets += len(parsed.snippets)
+                    print(f"Found {len(parsed.snippets)} snippets in {src_file}:")
+                    try:
+                        for snippet in parsed.snippets:
+                            print_snippet_debug(snippet, src_file, parsed)
+                    except Exception as e:
+                        print(f"Error reading file for debug: {e}", file=sys.stderr)
+                    continue
+
+                # katla output only depends on these files, the command it is
+                # run with and katla itself; this script is included too so
+                # that changes to how outputs are written invalidate them
+                try:
+                    inputs_digest = (
+                        repr((script_stamp(), file_stamp(katla))).encode()
+                        + digest_file(src_file)
+                        + digest_file(ttm_file)
+                    )
+                except OSError as e:
+                    print(
+                        f"Error reading '{src_file}' or '{ttm_file}': {e}",
+                        file=sys.stderr,
+                    )
+                    continue
+
+                snippets = parse_file_cached(src_file, cache)
+                total_snippets += len(snippets)
+                keys = [
+                    macro_key(
+                        inputs_digest,
+                        katla_command(snippet, src_file, ttm_file, katla),
+                    )
+                    for snippet in snippets
+                ]
+
+                print(f"Found {len(snippets)} snippets")
+                # Add file header to the combined content
+                if snippets:
+                    out.write(f"% Macros from {src_file}\n".encode())
+
+                # katla runs as a separate process, so threads only wait on it
+                with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                    try:
+                        # Only run katla for snippets without a reusable output
+                        futures = {
+                            key: executor.submit(
+                                run_katla_command,
+                                snippet,
+                                src_file,
+                                ttm_file,
+                                args.dry_run,
+                                katla,
+                            )
+                            for snippet, key in zip(snippets, keys)
+                            if key not in previous_macros
+                        }
+
+                        # Write outputs in snippet order
+                        for snippet, key in zip(snippets, keys):
+                            if key in futures:
+                                macro_output = futures[key].result()
+                            else:
+                                macro_output = previous_macros[key]
+                                with print_lock:
+                                    print(f"Reused macro for {snippet.name}")
+
+                            if macro_output and not macro_output.startswith(b"% Error"):
+                                # Tag the output so that later runs can reuse it
+                                out.write(
+                                    f"% katla-hash:{key} {len(macro_output)}\n".encode()
+                                )
+                                out.write(macro_output)
+                                if not macro_output.endswith(b"\n"):
+                                    out.write(b"\n")
+                                total_success += 1
+                            elif macro_output:
+                                out.write(macro_output)
+                    except BaseException:
+                        # Do not start katla for queued snippets after an
+                        # error or interrupt, e.g. Ctrl-C
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        raise
+
+                if snippets:
+                    out.write(b"\n")
+
+            if isinstance(out, io.BytesIO):
+                # In dry run, still show what would be in the combined file
+                line_count = out.getvalue().count(b"\n")
+                print(f"\nWould generate combined macro file with {line_count} lines")
+                return
+
+    except OSError as e:
+        print(f"Error writing combined macro file: {e}", file=sys.stderr)
+        sys.exit(1)
 
-        print(f"Processed {total_success}/{total_snippets} snippets successfully")
-        if total_success < total_snippets:
-            sys.exit(1)
-    else:
-        # In dry run, still show what would be in the combined file
-        print(
-            f"\nWould generate combined macro file with {len(all_macro_content)} lines"
-        )
+    if not args.no_cache:
+        save_snippet_cache(cache_file, cache)
+
+    print(f"\nGenerated combined macro file: {output_file}")
+    print(f"Processed {total_success}/{total_snippets} snippets successfully")
+    if total_success < total_snippets:
+        sys.exit(1)
 
 
 if __name__ == "__main__":